@@ -181,6 +181,7 @@ class AbstractAgent(aobject, Generic[KernelObjectType, KernelCreationContextType
     etcd: AsyncEtcd
     agent_id: str
     kernel_registry: MutableMapping[KernelId, AbstractKernel]
+    container_to_kernel: MutableMapping[ContainerId, KernelId]
     computers: MutableMapping[str, ComputerContext]
     images: Mapping[str, str]
     port_pool: Set[int]
@@ -216,6 +217,7 @@ class AbstractAgent(aobject, Generic[KernelObjectType, KernelCreationContextType
         self.local_config = local_config
         self.agent_id = generate_agent_id(__file__)
         self.kernel_registry = {}
+        self.container_to_kernel = {}
         self.computers = {}
         self.images = {}  # repoTag -> digest
         self.restarting_kernels = {}
@@ -542,6 +544,7 @@ class AbstractAgent(aobject, Generic[KernelObjectType, KernelCreationContextType
                         kernel_obj.clean_event.set()
                     # Forget.
                     self.kernel_registry.pop(ev.kernel_id, None)
+                    self.container_to_kernel.pop(ContainerId(kernel_obj['container_id']), None)
             finally:
                 if ev.done_event is not None:
                     ev.done_event.set()
@@ -784,8 +787,9 @@ class AbstractAgent(aobject, Generic[KernelObjectType, KernelCreationContextType
         try:
             with open(ipc_base_path / f'last_registry.{self.agent_id}.dat', 'rb') as f:
                 self.kernel_registry = pickle.load(f)
-                for kernel_obj in self.kernel_registry.values():
+                for kernel_id, kernel_obj in self.kernel_registry.items():
                     kernel_obj.agent_config = self.local_config
+                    self.container_to_kernel[ContainerId(kernel_obj['container_id'])] = kernel_id
                     if kernel_obj.runner is not None:
                         await kernel_obj.runner.__ainit__()
         except FileNotFoundError:
@@ -1435,6 +1439,7 @@ class AbstractAgent(aobject, Generic[KernelObjectType, KernelCreationContextType
             cmdargs,
         )
         self.kernel_registry[ctx.kernel_id] = kernel_obj
+        self.container_to_kernel[ContainerId(kernel_obj['container_id'])] = ctx.kernel_id
         log.debug('kernel repl-in address: {0}:{1}',
                   kernel_obj['kernel_host'], kernel_obj['repl_in_port'])
         log.debug('kernel repl-out address: {0}:{1}',
@@ -23,6 +23,7 @@ import psutil
 from ai.backend.common.logging import BraceStyleAdapter
 from ai.backend.common.utils import current_loop, nmget
 from ai.backend.common.types import (
+    ContainerId,
     DeviceName, DeviceId,
     DeviceModelInfo,
     SlotName, SlotTypes,
@@ -410,10 +411,8 @@ class MemoryPlugin(AbstractComputePlugin):
             -> Sequence[ContainerMeasurement]:
 
         def get_scratch_size(container_id: str) -> int:
-            for kernel_id, info in ctx.agent.kernel_registry.items():
-                if info['container_id'] == container_id:
-                    break
-            else:
+            kernel_id = ctx.agent.container_to_kernel.get(ContainerId(container_id))
+            if kernel_id is None:
                 return 0
             work_dir = ctx.agent.local_config['container']['scratch-root'] / str(kernel_id) / 'work'
             total_size = 0
@@ -5,22 +5,32 @@ Reference: https://www.datadoghq.com/blog/how-to-collect-docker-metrics/
 """
 
 import asyncio
+from collections import defaultdict
 from decimal import Decimal
 import enum
 import logging
+import math
+import operator
 import sys
 import time
+from types import MappingProxyType
 from typing import (
+    Any,
     Callable,
+    DefaultDict,
     Dict,
     FrozenSet,
+    Iterable,
     List,
     Mapping,
     MutableMapping,
     Optional,
     Sequence,
+    Set,
     Tuple,
     TYPE_CHECKING,
+    Union,
+    cast,
 )
 
 import attr
@@ -33,9 +43,7 @@ from ai.backend.common.types import (
     ContainerId, DeviceId, KernelId,
     MetricKey, MetricValue, MovingStatValue,
 )
-from .utils import (
-    remove_exponent,
-)
+from ai.backend.common.utils import current_loop
 if TYPE_CHECKING:
     from .agent import AbstractAgent
 
@@ -79,6 +87,11 @@ class MetricTypes(enum.Enum):
     ACCUMULATED = 3  # for accumulated value (e.g., total number of events)
 
 
+# Shared as the default of the read-only measurement mappings
+# to avoid allocating an empty dict for every measurement.
+_empty_mapping: Mapping[Any, Any] = MappingProxyType({})
+
+
 @attr.s(auto_attribs=True, slots=True)
 class Measurement:
     value: Decimal
@@ -95,9 +108,9 @@ class NodeMeasurement:
     key: str
     type: MetricTypes
     per_node: Measurement
-    per_device: Mapping[DeviceId, Measurement] = attr.Factory(dict)
+    per_device: Mapping[DeviceId, Measurement] = _empty_mapping
     unit_hint: Optional[str] = None
-    stats_filter: FrozenSet[str] = attr.Factory(frozenset)
+    stats_filter: FrozenSet[str] = frozenset()
     current_hook: Optional[Callable[['Metric'], Decimal]] = None
 
 
@@ -108,91 +121,199 @@ class ContainerMeasurement:
     """
     key: str
     type: MetricTypes
-    per_container: Mapping[str, Measurement] = attr.Factory(dict)
+    per_container: Mapping[str, Measurement] = _empty_mapping
     unit_hint: Optional[str] = None
-    stats_filter: FrozenSet[str] = attr.Factory(frozenset)
+    stats_filter: FrozenSet[str] = frozenset()
     current_hook: Optional[Callable[['Metric'], Decimal]] = None
 
 
+# KEYS: the stat keys
+# ARGV: the serialized stat values for each key, followed by the TTL in msec
+_set_all_script = '''
+local ttl = ARGV[#ARGV]
+for i = 1, #KEYS do
+    redis.call('SET', KEYS[i], ARGV[i], 'PX', ttl)
+end
+'''
+
+_moving_stat_keys = ('min', 'max', 'sum', 'avg', 'diff', 'rate')
+
+
+def _quantize_to_str(value: Union[float, Decimal], places: int = 3) -> str:
+    """
+    Format the value with the given number of decimal places,
+    stripping the trailing zeros like :func:`remove_exponent()`.
+    """
+    s = format(value, f'.{places}f')
+    if '.' in s:
+        s = s.rstrip('0').rstrip('.')
+    return s
+
+
+def _pct_to_str(current: float, capacity: float) -> Optional[str]:
+    # The percentage is only for display, so we use plain float arithmetic here.
+    if not (0.0 < capacity < math.inf):
+        return None
+    return _quantize_to_str(current * 100.0 / capacity, 2)
+
+
+def _to_decimal(value: float) -> Decimal:
+    # Use the shortest round-trip representation of the float
+    # instead of its exact binary expansion.
+    return Decimal(repr(value))
+
+
+def _cancel_remaining_tasks(tasks: Iterable[asyncio.Task]) -> None:
+    """
+    Cancel the tasks not finished yet and mark the exceptions of the finished ones
+    as retrieved, when the caller stops waiting for them due to cancellation or errors.
+    """
+    for task in tasks:
+        if not task.done():
+            task.cancel()
+        else:
+            _retrieve_exception(task)
+
+
+def _retrieve_exception(task: asyncio.Task) -> None:
+    # Mark the exception as retrieved to suppress the "never retrieved" warning
+    # when nobody is left to await the task.
+    if not task.cancelled():
+        task.exception()
+
+
 class MovingStatistics:
+    """
+    Keeps the running statistics of a metric.
+
+    The internal state is kept as native floats to keep :meth:`update()` cheap,
+    as it is called for every metric of every device and container in each
+    collection round.  All statistics are calculated in :meth:`update()` and
+    converted back to :class:`Decimal` only when accessed via the properties.
+    """
     __slots__ = (
         '_sum', '_count',
-        '_min', '_max', '_last',
+        '_min', '_max', '_avg',
+        '_diff', '_rate',
+        '_last_v', '_last_t',
     )
-    _sum: Decimal
+    _sum: float
     _count: int
-    _min: Decimal
-    _max: Decimal
-    _last: List[Tuple[Decimal, float]]
-
-    def __init__(self, initial_value: Decimal = None):
-        self._last = []
+    _min: float
+    _max: float
+    _avg: float
+    _diff: float
+    _rate: float
+    _last_v: float
+    _last_t: float
+
+    def __init__(self, initial_value: Decimal = None, now: float = None):
+        self._diff = 0.0
+        self._rate = 0.0
         if initial_value is None:
-            self._sum = Decimal(0)
-            self._min = Decimal('inf')
-            self._max = Decimal('-inf')
+            self._sum = 0.0
+            self._min = float('inf')
+            self._max = float('-inf')
+            self._avg = 0.0
             self._count = 0
+            self._last_v = 0.0
+            self._last_t = 0.0
         else:
-            self._sum = initial_value
-            self._min = initial_value
-            self._max = initial_value
+            v = float(initial_value)
+            self._sum = v
+            self._min = v
+            self._max = v
+            self._avg = v
             self._count = 1
-            point = (initial_value, time.perf_counter())
-            self._last.append(point)
+            self._last_v = v
+            self._last_t = now if now is not None else time.perf_counter()
+
+    def update(self, value: Decimal, now: float = None):
+        """
+        Add a new data point.
 
-    def update(self, value: Decimal):
-        self._sum += value
-        self._min = min(self._min, value)
-        self._max = max(self._max, value)
+        *now* is the timestamp of the data point used to calculate the rate.
+        The callers updating many metrics at once may pass the same value for all
+        of them, which must come from the same clock used to create this instance.
+        If not given, :func:`time.perf_counter()` is used.
+        """
+        v = float(value)
+        if now is None:
+            now = time.perf_counter()
+        # diff and rate are calculated from the latest two data points
+        if self._count > 0:
+            self._diff = v - self._last_v
+            interval = now - self._last_t
+            # keep the last rate if the clock has not advanced
+            if interval > 0:
+                self._rate = self._diff / interval
+        self._last_v = v
+        self._last_t = now
+        self._sum += v
+        if v < self._min:
+            self._min = v
+        if v > self._max:
+            self._max = v
         self._count += 1
-        point = (value, time.perf_counter())
-        self._last.append(point)
-        # keep only the latest two data points
-        if len(self._last) > 2:
-            self._last.pop(0)
+        self._avg = self._sum / self._count
 
     @property
     def min(self) -> Decimal:
-        return self._min
+        return _to_decimal(self._min)
 
     @property
     def max(self) -> Decimal:
-        return self._max
+        return _to_decimal(self._max)
 
     @property
     def sum(self) -> Decimal:
-        return self._sum
+        return _to_decimal(self._sum)
 
     @property
     def avg(self) -> Decimal:
-        return self._sum / self._count
+        return _to_decimal(self._avg)
 
     @property
     def diff(self) -> Decimal:
-        if len(self._last) == 2:
-            return self._last[-1][0] - self._last[-2][0]
-        return Decimal(0)
+        return _to_decimal(self._diff)
 
     @property
     def rate(self) -> Decimal:
-        if len(self._last) == 2:
-            return ((self._last[-1][0] - self._last[-2][0]) /
-                    Decimal(self._last[-1][1] - self._last[-2][1]))
-        return Decimal(0)
+        return _to_decimal(self._rate)
 
-    def to_serializable_dict(self) -> MovingStatValue:
-        q = Decimal('0.000')
+    def to_serializable_dict(self, keys: Iterable[str] = None) -> MovingStatValue:
+        """
+        Serialize the statistics as quantized strings.
+
+        If *keys* is given, only the listed statistics are calculated and included
+        in the result (without the version field).
+        """
+        if keys is not None:
+            return cast(MovingStatValue, {
+                k: _quantize_to_str(_stat_value_getters[k](self))
+                for k in keys
+            })
         return {
-            'min': str(remove_exponent(self.min.quantize(q))),
-            'max': str(remove_exponent(self.max.quantize(q))),
-            'sum': str(remove_exponent(self.sum.quantize(q))),
-            'avg': str(remove_exponent(self.avg.quantize(q))),
-            'diff': str(remove_exponent(self.diff.quantize(q))),
-            'rate': str(remove_exponent(self.rate.quantize(q))),
+            'min': _quantize_to_str(self._min),
+            'max': _quantize_to_str(self._max),
+            'sum': _quantize_to_str(self._sum),
+            'avg': _quantize_to_str(self._avg),
+            'diff': _quantize_to_str(self._diff),
+            'rate': _quantize_to_str(self._rate),
             'version': 2,
         }
 
 
+_stat_value_getters: Mapping[str, Callable[[MovingStatistics], float]] = {
+    'min': operator.attrgetter('_min'),
+    'max': operator.attrgetter('_max'),
+    'sum': operator.attrgetter('_sum'),
+    'avg': operator.attrgetter('_avg'),
+    'diff': operator.attrgetter('_diff'),
+    'rate': operator.attrgetter('_rate'),
+}
+
+
 @attr.s(auto_attribs=True, slots=True)
 class Metric:
     key: str
@@ -203,56 +324,88 @@ class Metric:
     capacity: Optional[Decimal] = None
     unit_hint: Optional[str] = None
     current_hook: Optional[Callable[['Metric'], Decimal]] = None
+    _filter_keys: Tuple[str, ...] = attr.ib(init=False, repr=False, eq=False)
+    _cached: Optional[MetricValue] = attr.ib(init=False, default=None, repr=False, eq=False)
+
+    def __attrs_post_init__(self) -> None:
+        self._filter_keys = tuple(k for k in _moving_stat_keys if k in self.stats_filter)
 
-    def update(self, value: Measurement):
+    def update(self, value: Measurement, now: float = None):
         if value.capacity is not None:
             self.capacity = value.capacity
-        self.stats.update(value.value)
+        self.stats.update(value.value, now)
         self.current = value.value
         if self.current_hook is not None:
             self.current = self.current_hook(self)
+        self._cached = None
 
     def to_serializable_dict(self) -> MetricValue:
-        q = Decimal('0.000')
-        q_pct = Decimal('0.00')
-        return {
-            'current': str(remove_exponent(self.current.quantize(q))),
-            'capacity': (str(remove_exponent(self.capacity.quantize(q)))
+        """
+        Serialize the metric as quantized strings.
+
+        The result is cached until the next :meth:`update()` call,
+        so the caller must not modify it.
+        """
+        if self._cached is not None:
+            return self._cached
+        result: MetricValue = {
+            'current': _quantize_to_str(self.current),
+            'capacity': (_quantize_to_str(self.capacity)
                          if self.capacity is not None else None),
-            'pct': (
-                str(remove_exponent(
-                    (Decimal(self.current) / Decimal(self.capacity) * 100).quantize(q_pct)))
-                if (self.capacity is not None and
-                    self.capacity.is_normal() and
-                    self.capacity > 0)
-                else None),
-            'unit_hint': self.unit_hint,
-            **{f'stats.{k}': v  # type: ignore
-               for k, v in self.stats.to_serializable_dict().items()
-               if k in self.stats_filter},
+            'pct': (_pct_to_str(float(self.current), float(self.capacity))
+                    if self.capacity is not None else None),
+            'unit_hint': self.unit_hint,  # type: ignore
         }
+        if self._filter_keys:
+            for k, v in self.stats.to_serializable_dict(self._filter_keys).items():
+                result[f'stats.{k}'] = v  # type: ignore
+        self._cached = result
+        return result
 
 
 class StatContext:
 
     agent: 'AbstractAgent'
     mode: StatModes
-    node_metrics: Mapping[MetricKey, Metric]
-    device_metrics: Mapping[MetricKey, MutableMapping[DeviceId, Metric]]
-    kernel_metrics: MutableMapping[KernelId, MutableMapping[MetricKey, Metric]]
+    node_metrics: MutableMapping[MetricKey, Metric]
+    device_metrics: MutableMapping[MetricKey, MutableMapping[DeviceId, Metric]]
+    kernel_metrics: DefaultDict[KernelId, MutableMapping[MetricKey, Metric]]
 
     def __init__(self, agent: 'AbstractAgent', mode: StatModes = None, *,
-                 cache_lifespan: float = 120.0) -> None:
+                 cache_lifespan: float = 120.0,
+                 batch_window: float = 0.02) -> None:
         self.agent = agent
         self.mode = mode if mode is not None else StatModes.get_preferred_mode()
         self.cache_lifespan = cache_lifespan
+        self.batch_window = batch_window
+        self._agent_key = agent.local_config['agent']['id']
 
         self.node_metrics = {}
         self.device_metrics = {}
-        self.kernel_metrics = {}
+        self.kernel_metrics = defaultdict(dict)
 
         self._lock = asyncio.Lock()
         self._timestamps: MutableMapping[str, float] = {}
+        self._pending_container_ids: Set[ContainerId] = set()
+        self._container_stat_batch: Optional[asyncio.Task] = None
+        self._container_stat_waiters: Dict[asyncio.Task, int] = {}
+        self._kernel_keys: Dict[KernelId, str] = {}
+
+    def _get_kernel_key(self, kernel_id: KernelId) -> str:
+        # Kernel IDs are UUIDs, so cache their string forms used as the Redis keys.
+        key = self._kernel_keys.get(kernel_id)
+        if key is None:
+            key = self._kernel_keys[kernel_id] = str(kernel_id)
+        return key
+
+    async def _store_all(self, keys: List[str], values: List[Union[bytes, int]]) -> None:
+        # The script is loaded once and then invoked by its hash.
+        # aioredis accepts bytes and int arguments as well as str.
+        args = cast(List[str], [*values, int(self.cache_lifespan * 1000)])
+        await redis.execute_script(
+            self.agent.redis_stat_pool, 'stat_set_all', _set_all_script,
+            keys, args,
+        )
 
     def update_timestamp(self, timestamp_key: str) -> Tuple[float, float]:
         """
@@ -276,93 +429,85 @@ class StatContext:
 
         Intended to be used by the agent.
         """
-        async with self._lock:
-            # Here we use asyncio.gather() instead of aiotools.TaskGroup
-            # to keep methods of other plugins running when a plugin raises an error
-            # instead of cancelling them.
-            _tasks = []
-            for computer in self.agent.computers.values():
-                _tasks.append(computer.instance.gather_node_measures(self))
-            results = await asyncio.gather(*_tasks, return_exceptions=True)
-            for result in results:
-                if isinstance(result, Exception):
+        # Use the same timestamp for all metrics merged at once.
+        loop = current_loop()
+        # Here we use asyncio.as_completed() instead of aiotools.TaskGroup
+        # to keep methods of other plugins running when a plugin raises an error
+        # instead of cancelling them.
+        # The results are merged as soon as each plugin returns, holding the lock
+        # only while merging so that slow plugins do not block other stat collectors.
+        # The plugin tasks still running are cancelled when the collector itself is
+        # cancelled (e.g., on agent shutdown) or fails while merging.
+        _tasks = []
+        for computer in self.agent.computers.values():
+            _tasks.append(asyncio.create_task(computer.instance.gather_node_measures(self)))
+        try:
+            for fut in asyncio.as_completed(_tasks):
+                try:
+                    node_measures = await fut
+                except Exception as e:
                     log.error('collect_node_stat(): gather_node_measures() error',
-                              exc_info=result)
+                              exc_info=e)
                     continue
-                for node_measure in result:
-                    metric_key = node_measure.key
-                    # update node metric
-                    if metric_key not in self.node_metrics:
-                        self.node_metrics[metric_key] = Metric(
-                            metric_key, node_measure.type,
-                            current=node_measure.per_node.value,
-                            capacity=node_measure.per_node.capacity,
-                            unit_hint=node_measure.unit_hint,
-                            stats=MovingStatistics(node_measure.per_node.value),
-                            stats_filter=frozenset(node_measure.stats_filter),
-                            current_hook=node_measure.current_hook,
-                        )
-                    else:
-                        self.node_metrics[metric_key].update(node_measure.per_node)
-                    # update per-device metric
-                    # NOTE: device IDs are defined by each metric keys.
-                    for dev_id, measure in node_measure.per_device.items():
-                        dev_id = str(dev_id)
-                        if metric_key not in self.device_metrics:
-                            self.device_metrics[metric_key] = {}
-                        if dev_id not in self.device_metrics[metric_key]:
-                            self.device_metrics[metric_key][dev_id] = Metric(
+                async with self._lock:
+                    now = loop.time()
+                    for node_measure in node_measures:
+                        metric_key = MetricKey(node_measure.key)
+                        # share the same filter set for the node and all devices
+                        stats_filter = frozenset(node_measure.stats_filter)
+                        # update node metric
+                        metric = self.node_metrics.get(metric_key)
+                        if metric is None:
+                            # intern the keys only when inserted as they live long
+                            metric_key = MetricKey(sys.intern(metric_key))
+                            self.node_metrics[metric_key] = Metric(
                                 metric_key, node_measure.type,
-                                current=measure.value,
-                                capacity=measure.capacity,
+                                current=node_measure.per_node.value,
+                                capacity=node_measure.per_node.capacity,
                                 unit_hint=node_measure.unit_hint,
-                                stats=MovingStatistics(measure.value),
-                                stats_filter=frozenset(node_measure.stats_filter),
+                                stats=MovingStatistics(node_measure.per_node.value, now),
+                                stats_filter=stats_filter,
                                 current_hook=node_measure.current_hook,
                             )
                         else:
-                            self.device_metrics[metric_key][dev_id].update(measure)
-
-            # gather container metrics from compute plugins
-            container_ids = []
-            kernel_id_map = {}
-            used_kernel_ids = set()
-            for kid, kobj in self.agent.kernel_registry.items():
-                cid = kobj['container_id']
-                container_ids.append(cid)
-                kernel_id_map[cid] = kid
-                used_kernel_ids.add(kid)
+                            metric.update(node_measure.per_node, now)
+                        # update per-device metric
+                        # NOTE: device IDs are defined by each metric keys.
+                        # Create the per-key bucket only when there are devices
+                        # so that device-less metrics do not appear as empty entries.
+                        device_metrics = self.device_metrics.get(metric_key)
+                        for dev_id, measure in node_measure.per_device.items():
+                            dev_id = str(dev_id)
+                            if device_metrics is None:
+                                metric_key = MetricKey(sys.intern(metric_key))
+                                device_metrics = self.device_metrics[metric_key] = {}
+                            metric = device_metrics.get(dev_id)
+                            if metric is None:
+                                device_metrics[dev_id] = Metric(
+                                    metric_key, node_measure.type,
+                                    current=measure.value,
+                                    capacity=measure.capacity,
+                                    unit_hint=node_measure.unit_hint,
+                                    stats=MovingStatistics(measure.value, now),
+                                    stats_filter=stats_filter,
+                                    current_hook=node_measure.current_hook,
+                                )
+                            else:
+                                metric.update(measure, now)
+        finally:
+            _cancel_remaining_tasks(_tasks)
+
+        # gather container metrics from compute plugins
+        container_to_kernel = self.agent.container_to_kernel
+        container_ids = [*container_to_kernel.keys()]
+        async with self._lock:
+            used_kernel_ids = set(container_to_kernel.values())
             unused_kernel_ids = set(self.kernel_metrics.keys()) - used_kernel_ids
             for unused_kernel_id in unused_kernel_ids:
                 log.debug('removing kernel_metric for {}', unused_kernel_id)
                 self.kernel_metrics.pop(unused_kernel_id, None)
-            _tasks = []
-            for computer in self.agent.computers.values():
-                _tasks.append(computer.instance.gather_container_measures(self, container_ids))
-            for ctnr_measures in (await asyncio.gather(*_tasks, return_exceptions=True)):
-                if isinstance(ctnr_measures, Exception):
-                    log.error('gather_container_measures error',
-                              exc_info=ctnr_measures)
-                    continue
-                for ctnr_measure in ctnr_measures:
-                    metric_key = ctnr_measure.key
-                    # update per-container metric
-                    for cid, measure in ctnr_measure.per_container.items():
-                        kernel_id = kernel_id_map[cid]
-                        if kernel_id not in self.kernel_metrics:
-                            self.kernel_metrics[kernel_id] = {}
-                        if metric_key not in self.kernel_metrics[kernel_id]:
-                            self.kernel_metrics[kernel_id][metric_key] = Metric(
-                                metric_key, ctnr_measure.type,
-                                current=measure.value,
-                                capacity=measure.value,
-                                unit_hint=ctnr_measure.unit_hint,
-                                stats=MovingStatistics(measure.value),
-                                stats_filter=frozenset(ctnr_measure.stats_filter),
-                                current_hook=ctnr_measure.current_hook,
-                            )
-                        else:
-                            self.kernel_metrics[kernel_id][metric_key].update(measure)
+                self._kernel_keys.pop(unused_kernel_id, None)
+        await self._gather_container_measures(container_ids)
 
         # push to the Redis server
         redis_agent_updates = {
@@ -378,22 +523,86 @@ class StatContext:
         }
         if self.agent.local_config['debug']['log-stats']:
             log.debug('stats: node_updates: {0}: {1}',
-                      self.agent.local_config['agent']['id'], redis_agent_updates['node'])
-        serialized_agent_updates = msgpack.packb(redis_agent_updates)
-
-        def _pipe_builder():
-            pipe = self.agent.redis_stat_pool.pipeline()
-            pipe.set(self.agent.local_config['agent']['id'], serialized_agent_updates)
-            pipe.expire(self.agent.local_config['agent']['id'], self.cache_lifespan)
-            for kernel_id, metrics in self.kernel_metrics.items():
-                serialized_metrics = {
-                    key: obj.to_serializable_dict()
-                    for key, obj in metrics.items()
-                }
-                pipe.set(str(kernel_id), msgpack.packb(serialized_metrics))
-                pipe.expire(str(kernel_id), self.cache_lifespan)
-            return pipe
-        await redis.execute_with_retries(_pipe_builder)
+                      self._agent_key, redis_agent_updates['node'])
+        keys = [self._agent_key]
+        values = [msgpack.packb(redis_agent_updates)]
+        for kernel_id, metrics in self.kernel_metrics.items():
+            serialized_metrics = {
+                key: obj.to_serializable_dict()
+                for key, obj in metrics.items()
+            }
+            keys.append(self._get_kernel_key(kernel_id))
+            values.append(msgpack.packb(serialized_metrics))
+        # Store the agent and kernel stats with a single command
+        # while keeping them as separate keys read by the manager.
+        await self._store_all(keys, values)
+
+    async def _gather_container_measures(
+        self,
+        container_ids: Sequence[ContainerId],
+    ) -> Set[KernelId]:
+        """
+        Gather the container measures from all compute plugins and merge them
+        into the kernel metrics, returning the IDs of the updated kernels.
+        """
+        loop = current_loop()
+        updated_kernel_ids: Set[KernelId] = set()
+        # Here we use asyncio.as_completed() instead of aiotools.TaskGroup
+        # to keep methods of other plugins running when a plugin raises an error
+        # instead of cancelling them.
+        _tasks = []
+        for computer in self.agent.computers.values():
+            _tasks.append(asyncio.create_task(
+                computer.instance.gather_container_measures(self, container_ids)
+            ))
+        try:
+            for fut in asyncio.as_completed(_tasks):
+                try:
+                    ctnr_measures = await fut
+                except Exception as e:
+                    log.error('gather_container_measures() error', exc_info=e)
+                    continue
+                async with self._lock:
+                    updated_kernel_ids |= self._merge_container_measures(ctnr_measures, loop.time())
+        finally:
+            _cancel_remaining_tasks(_tasks)
+        return updated_kernel_ids
+
+    def _merge_container_measures(
+        self,
+        ctnr_measures: Sequence[ContainerMeasurement],
+        now: float,
+    ) -> Set[KernelId]:
+        # Must be called with the lock held.
+        container_to_kernel = self.agent.container_to_kernel
+        updated_kernel_ids: Set[KernelId] = set()
+        for ctnr_measure in ctnr_measures:
+            metric_key = MetricKey(ctnr_measure.key)
+            # share the same filter set for all containers
+            stats_filter = frozenset(ctnr_measure.stats_filter)
+            # update per-container metric
+            for cid, measure in ctnr_measure.per_container.items():
+                kernel_id = container_to_kernel.get(ContainerId(cid))
+                if kernel_id is None:
+                    # the kernel is destroyed while gathering
+                    continue
+                updated_kernel_ids.add(kernel_id)
+                kernel_metrics = self.kernel_metrics[kernel_id]
+                metric = kernel_metrics.get(metric_key)
+                if metric is None:
+                    metric_key = MetricKey(sys.intern(metric_key))
+                    kernel_metrics[metric_key] = Metric(
+                        metric_key, ctnr_measure.type,
+                        current=measure.value,
+                        capacity=measure.value,
+                        unit_hint=ctnr_measure.unit_hint,
+                        stats=MovingStatistics(measure.value, now),
+                        stats_filter=stats_filter,
+                        current_hook=ctnr_measure.current_hook,
+                    )
+                else:
+                    metric.update(measure, now)
+        return updated_kernel_ids
 
     async def collect_container_stat(
         self,
@@ -401,54 +610,71 @@ class StatContext:
     ) -> Mapping[MetricKey, Metric]:
         """
         Collect the per-container statistics only,
+        and return the metrics of the kernel of the last given container.
 
         Intended to be used by the agent and triggered by container cgroup synchronization processes.
+
+        The calls made within ``batch_window`` seconds are coalesced, so that the compute plugins
+        are invoked and the Redis server is updated only once for all of their containers.
         """
-        async with self._lock:
-            kernel_id_map: Dict[ContainerId, KernelId] = {}
-            for kid, info in self.agent.kernel_registry.items():
-                cid = info['container_id']
-                kernel_id_map[ContainerId(cid)] = kid
-            # Here we use asyncio.gather() instead of aiotools.TaskGroup
-            # to keep methods of other plugins running when a plugin raises an error
-            # instead of cancelling them.
-            _tasks = []
-            kernel_id = None
-            for computer in self.agent.computers.values():
-                _tasks.append(asyncio.create_task(
-                    computer.instance.gather_container_measures(self, container_ids)
-                ))
-            results = await asyncio.gather(*_tasks, return_exceptions=True)
-            for result in results:
-                if isinstance(result, Exception):
-                    log.error('collect_container_stat(): gather_container_measures() error',
-                              exc_info=result)
-                    continue
-                for ctnr_measure in result:
-                    metric_key = ctnr_measure.key
-                    # update per-container metric
-                    for cid, measure in ctnr_measure.per_container.items():
-                        try:
-                            kernel_id = kernel_id_map[cid]
-                        except KeyError:
-                            continue
-                        if kernel_id not in self.kernel_metrics:
-                            self.kernel_metrics[kernel_id] = {}
-                        if metric_key not in self.kernel_metrics[kernel_id]:
-                            self.kernel_metrics[kernel_id][metric_key] = Metric(
-                                metric_key, ctnr_measure.type,
-                                current=measure.value,
-                                capacity=measure.value,
-                                unit_hint=ctnr_measure.unit_hint,
-                                stats=MovingStatistics(measure.value),
-                                stats_filter=frozenset(ctnr_measure.stats_filter),
-                                current_hook=ctnr_measure.current_hook,
-                            )
-                        else:
-                            self.kernel_metrics[kernel_id][metric_key].update(measure)
+        container_to_kernel = self.agent.container_to_kernel
+        container_ids = [cid for cid in container_ids if cid in container_to_kernel]
+        if not container_ids:
+            return {}
+        self._pending_container_ids.update(container_ids)
+        batch = self._container_stat_batch
+        if batch is None:
+            batch = asyncio.create_task(self._collect_container_stat_batch())
+            batch.add_done_callback(self._container_stat_batch_done)
+            self._container_stat_batch = batch
+        # Shield the batch from cancellation of an individual caller
+        # as other callers may be waiting for it.
+        waiters = self._container_stat_waiters
+        waiters[batch] = waiters.get(batch, 0) + 1
+        try:
+            updated_metrics = await asyncio.shield(batch)
+        finally:
+            waiters[batch] -= 1
+            if waiters[batch] == 0:
+                del waiters[batch]
+                # Cancel the batch along with its plugin tasks when the last caller
+                # is cancelled (e.g., on agent shutdown).
+                if not batch.done():
+                    batch.cancel()
+        for cid in reversed(container_ids):
+            kernel_id = container_to_kernel.get(cid)
+            if kernel_id is not None and kernel_id in updated_metrics:
+                return updated_metrics[kernel_id]
+        return {}
+
+    def _container_stat_batch_done(self, task: asyncio.Task) -> None:
+        # The batch may be cancelled even before it starts,
+        # so let the subsequent calls start a new batch here as well.
+        if self._container_stat_batch is task:
+            self._container_stat_batch = None
+        # All callers may have been cancelled while the batch was running.
+        _retrieve_exception(task)
 
-        if kernel_id is not None:
-            metrics = self.kernel_metrics[kernel_id]
+    async def _collect_container_stat_batch(
+        self,
+    ) -> Mapping[KernelId, Mapping[MetricKey, Metric]]:
+        await asyncio.sleep(self.batch_window)
+        container_ids = [*self._pending_container_ids]
+        self._pending_container_ids.clear()
+        # Let the subsequent calls start a new batch.
+        self._container_stat_batch = None
+
+        updated_kernel_ids = await self._gather_container_measures(container_ids)
+
+        updated_metrics: Dict[KernelId, Mapping[MetricKey, Metric]] = {}
+        keys: List[str] = []
+        values: List[Union[bytes, int]] = []
+        for kernel_id in updated_kernel_ids:
+            metrics = self.kernel_metrics.get(kernel_id)
+            if metrics is None:
+                # the kernel is destroyed while gathering
+                continue
+            updated_metrics[kernel_id] = metrics
             serializable_metrics = {
                 key: obj.to_serializable_dict()
                 for key, obj in metrics.items()
@@ -456,13 +682,8 @@ class StatContext:
             if self.agent.local_config['debug']['log-stats']:
                 log.debug('kernel_updates: {0}: {1}',
                           kernel_id, serializable_metrics)
-            serialized_metrics = msgpack.packb(serializable_metrics)
-
-            def _pipe_builder():
-                pipe = self.agent.redis_stat_pool.pipeline()
-                pipe.set(str(kernel_id), serialized_metrics)
-                pipe.expire(str(kernel_id), self.cache_lifespan)
-                return pipe
-            await redis.execute_with_retries(_pipe_builder)
-            return metrics
-        return {}
+            keys.append(self._get_kernel_key(kernel_id))
+            values.append(msgpack.packb(serializable_metrics))
+        if keys:
+            await self._store_all(keys, values)
+        return updated_metrics
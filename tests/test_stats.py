@@ -1 +1,403 @@
-# currently empty
+import asyncio
+from decimal import Decimal
+from unittest.mock import AsyncMock, MagicMock
+
+import pytest
+
+from ai.backend.common import msgpack, redis
+from ai.backend.agent.stats import (
+    ContainerMeasurement,
+    Measurement,
+    Metric,
+    MetricTypes,
+    MovingStatistics,
+    NodeMeasurement,
+    StatContext,
+    StatModes,
+)
+
+
+class Dummy:
+    pass
+
+
+class DummyComputePlugin:
+
+    async def gather_node_measures(self, ctx):
+        return [
+            NodeMeasurement(
+                'mem', MetricTypes.USAGE,
+                per_node=Measurement(Decimal('1024'), Decimal('4096')),
+                per_device={'root': Measurement(Decimal('1024'), Decimal('4096'))},
+                unit_hint='bytes',
+            ),
+            NodeMeasurement(
+                'cpu_util', MetricTypes.UTILIZATION,
+                per_node=Measurement(Decimal('50'), Decimal('100')),
+                unit_hint='percent',
+            ),
+        ]
+
+    async def gather_container_measures(self, ctx, container_ids):
+        return [
+            ContainerMeasurement(
+                'mem', MetricTypes.USAGE,
+                per_container={cid: Measurement(Decimal('256')) for cid in container_ids},
+                unit_hint='bytes',
+                stats_filter=frozenset({'max'}),
+            ),
+        ]
+
+
+@pytest.fixture
+def stat_ctx(mocker):
+    agent = Dummy()
+    agent.local_config = {
+        'agent': {'id': 'i-testing'},
+        'debug': {'log-stats': False},
+    }
+    computer = Dummy()
+    computer.instance = DummyComputePlugin()
+    agent.computers = {'dummy': computer}
+    agent.container_to_kernel = {'c1': 'k1', 'c2': 'k2'}
+    agent.redis_stat_pool = MagicMock()
+    mocker.patch('ai.backend.agent.stats.redis.execute_script', new=AsyncMock())
+    return StatContext(agent, mode=StatModes.DOCKER)
+
+
+def test_moving_statistics_initial_value():
+    s = MovingStatistics(Decimal('10.5'))
+    assert s.min == Decimal('10.5')
+    assert s.max == Decimal('10.5')
+    assert s.sum == Decimal('10.5')
+    assert s.avg == Decimal('10.5')
+    assert s.diff == Decimal(0)
+    assert s.rate == Decimal(0)
+
+
+def test_moving_statistics_update(mocker):
+    mock_perf_counter = mocker.patch('ai.backend.agent.stats.time.perf_counter')
+    mock_perf_counter.side_effect = [1.0, 3.0, 5.0]
+    s = MovingStatistics(Decimal('10'))
+    s.update(Decimal('14'))
+    assert s.min == Decimal('10')
+    assert s.max == Decimal('14')
+    assert s.sum == Decimal('24')
+    assert s.avg == Decimal('12')
+    assert s.diff == Decimal('4')
+    assert s.rate == Decimal('2')
+
+    s.update(Decimal('4'))
+    assert s.min == Decimal('4')
+    assert s.max == Decimal('14')
+    assert s.sum == Decimal('28')
+    assert s.diff == Decimal('-10')
+    assert s.rate == Decimal('-5')
+
+    serialized = s.to_serializable_dict()
+    assert serialized == {
+        'min': '4',
+        'max': '14',
+        'sum': '28',
+        'avg': '9.333',
+        'diff': '-10',
+        'rate': '-5',
+        'version': 2,
+    }
+
+
+def test_moving_statistics_keeps_latest_two_points(mocker):
+    mock_perf_counter = mocker.patch('ai.backend.agent.stats.time.perf_counter')
+    mock_perf_counter.side_effect = [float(t) for t in range(10)]
+    s = MovingStatistics(Decimal('0'))
+    for v in range(1, 10):
+        s.update(Decimal(v * v))
+    # only the last two points (64 @ t=8, 81 @ t=9) are used.
+    assert s.diff == Decimal('17')
+    assert s.rate == Decimal('17')
+    assert s.min == Decimal('0')
+    assert s.max == Decimal('81')
+
+
+def test_moving_statistics_explicit_timestamps():
+    s = MovingStatistics(Decimal('10'), 100.0)
+    s.update(Decimal('20'), 102.0)
+    assert s.diff == Decimal('10')
+    assert s.rate == Decimal('5')
+    # the rate is kept if updated again with the same timestamp.
+    s.update(Decimal('30'), 102.0)
+    assert s.diff == Decimal('10')
+    assert s.rate == Decimal('5')
+
+
+def test_metric_serialization_with_stats_filter():
+    m = Metric(
+        'mem', MetricTypes.USAGE,
+        current=Decimal('512'),
+        capacity=Decimal('2048'),
+        unit_hint='bytes',
+        stats=MovingStatistics(Decimal('512')),
+        stats_filter=frozenset({'max', 'avg'}),
+    )
+    m.update(Measurement(Decimal('1024'), Decimal('2048')))
+    assert m.to_serializable_dict() == {
+        'current': '1024',
+        'capacity': '2048',
+        'pct': '50',
+        'unit_hint': 'bytes',
+        'stats.max': '1024',
+        'stats.avg': '768',
+    }
+
+    # serialization is cached until the next update.
+    assert m.to_serializable_dict() is m.to_serializable_dict()
+    m.update(Measurement(Decimal('1536'), Decimal('2048')))
+    serialized = m.to_serializable_dict()
+    assert serialized['current'] == '1536'
+    assert serialized['pct'] == '75'
+    assert serialized['stats.max'] == '1536'
+
+    m = Metric(
+        'cpu_used', MetricTypes.USAGE,
+        current=Decimal('10'),
+        stats=MovingStatistics(Decimal('10')),
+        stats_filter=frozenset(),
+    )
+    assert m.to_serializable_dict() == {
+        'current': '10',
+        'capacity': None,
+        'pct': None,
+        'unit_hint': None,
+    }
+
+
+def test_metric_serialization_pct():
+    m = Metric(
+        'cpu_util', MetricTypes.UTILIZATION,
+        current=Decimal('1'),
+        capacity=Decimal('3'),
+        stats=MovingStatistics(Decimal('1')),
+        stats_filter=frozenset(),
+    )
+    assert m.to_serializable_dict()['pct'] == '33.33'
+    m.update(Measurement(Decimal('2'), Decimal('0')))
+    assert m.to_serializable_dict()['pct'] is None
+    m.update(Measurement(Decimal('2'), Decimal('NaN')))
+    assert m.to_serializable_dict()['pct'] is None
+
+
+@pytest.mark.asyncio
+async def test_collect_node_stat(stat_ctx):
+    await stat_ctx.collect_node_stat()
+    assert stat_ctx.node_metrics['mem'].current == Decimal('1024')
+    assert stat_ctx.device_metrics['mem']['root'].capacity == Decimal('4096')
+    assert {*stat_ctx.kernel_metrics.keys()} == {'k1', 'k2'}
+
+    conn, script_id, _, keys, args = redis.execute_script.call_args.args
+    assert conn is stat_ctx.agent.redis_stat_pool
+    assert script_id == 'stat_set_all'
+    assert keys == ['i-testing', 'k1', 'k2']
+    assert args[-1] == 120_000
+    stored = {k: msgpack.unpackb(v) for k, v in zip(keys, args)}
+    assert stored['i-testing']['node']['mem']['pct'] == '25'
+    assert stored['i-testing']['node']['cpu_util']['pct'] == '50'
+    # metrics without any devices do not appear under 'devices'.
+    assert stored['i-testing']['devices'] == {
+        'mem': {'root': stored['i-testing']['devices']['mem']['root']},
+    }
+    assert 'cpu_util' not in stat_ctx.device_metrics
+    assert stored['k1'] == {
+        'mem': {
+            'current': '256',
+            'capacity': '256',
+            'pct': '100',
+            'unit_hint': 'bytes',
+            'stats.max': '256',
+        },
+    }
+
+    # kernel metrics of destroyed kernels are removed.
+    del stat_ctx.agent.container_to_kernel['c2']
+    await stat_ctx.collect_node_stat()
+    assert {*stat_ctx.kernel_metrics.keys()} == {'k1'}
+
+
+@pytest.mark.asyncio
+async def test_collect_container_stat(stat_ctx):
+    metrics = await stat_ctx.collect_container_stat(['c1', 'c-unknown'])
+    assert metrics['mem'].current == Decimal('256')
+    assert {*stat_ctx.kernel_metrics.keys()} == {'k1'}
+
+
+@pytest.mark.asyncio
+async def test_collect_container_stat_coalesced(stat_ctx, mocker):
+    plugin = stat_ctx.agent.computers['dummy'].instance
+    spy = mocker.spy(plugin, 'gather_container_measures')
+    metrics1, metrics2 = await asyncio.gather(
+        stat_ctx.collect_container_stat(['c1']),
+        stat_ctx.collect_container_stat(['c2']),
+    )
+    assert metrics1 is stat_ctx.kernel_metrics['k1']
+    assert metrics2 is stat_ctx.kernel_metrics['k2']
+    spy.assert_called_once()
+    assert sorted(spy.call_args.args[1]) == ['c1', 'c2']
+    # both kernels are stored with a single command.
+    redis.execute_script.assert_called_once()
+    keys = redis.execute_script.call_args.args[3]
+    assert sorted(keys) == ['k1', 'k2']
+
+    # a new batch is started for subsequent calls.
+    metrics1 = await stat_ctx.collect_container_stat(['c1'])
+    assert metrics1 is stat_ctx.kernel_metrics['k1']
+    assert spy.call_count == 2
+
+
+@pytest.mark.asyncio
+async def test_collect_container_stat_batch_cancelled(stat_ctx):
+    stat_ctx.batch_window = 10
+    caller = asyncio.create_task(stat_ctx.collect_container_stat(['c1']))
+    # let the batch start and wait for the batch window.
+    await asyncio.sleep(0)
+    await asyncio.sleep(0)
+    batch = stat_ctx._container_stat_batch
+    assert batch is not None
+    batch.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await caller
+    assert stat_ctx._container_stat_batch is None
+
+    # the subsequent calls start a new batch.
+    stat_ctx.batch_window = 0
+    metrics = await stat_ctx.collect_container_stat(['c1'])
+    assert metrics is stat_ctx.kernel_metrics['k1']
+
+
+@pytest.mark.asyncio
+async def test_collect_container_stat_cancelled_with_slow_plugin(stat_ctx):
+
+    class SlowComputePlugin:
+
+        def __init__(self):
+            self.started = asyncio.Event()
+            self.cancelled = False
+
+        async def gather_node_measures(self, ctx):
+            return []
+
+        async def gather_container_measures(self, ctx, container_ids):
+            self.started.set()
+            try:
+                await asyncio.sleep(10)
+            except asyncio.CancelledError:
+                self.cancelled = True
+                raise
+            return []
+
+    plugin = SlowComputePlugin()
+    computer = Dummy()
+    computer.instance = plugin
+    stat_ctx.agent.computers['slow'] = computer
+    callers = [
+        asyncio.create_task(stat_ctx.collect_container_stat(['c1'])),
+        asyncio.create_task(stat_ctx.collect_container_stat(['c2'])),
+    ]
+    await plugin.started.wait()
+    # the batch keeps running while any caller is waiting for it.
+    callers[0].cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await callers[0]
+    await asyncio.sleep(0)
+    assert not plugin.cancelled
+    # the batch is cancelled with its last caller.
+    callers[1].cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await callers[1]
+    # let the cancellation of the batch and its plugin tasks be delivered.
+    for _ in range(3):
+        await asyncio.sleep(0)
+    assert plugin.cancelled
+    assert stat_ctx._container_stat_waiters == {}
+
+
+@pytest.mark.asyncio
+async def test_collect_container_stat_unknown_containers(stat_ctx, mocker):
+    plugin = stat_ctx.agent.computers['dummy'].instance
+    spy = mocker.spy(plugin, 'gather_container_measures')
+    await stat_ctx._lock.acquire()
+    try:
+        # should return immediately without waiting for the lock.
+        metrics = await asyncio.wait_for(
+            stat_ctx.collect_container_stat(['c-unknown']),
+            timeout=1.0,
+        )
+    finally:
+        stat_ctx._lock.release()
+    assert metrics == {}
+    spy.assert_not_called()
+
+
+@pytest.mark.asyncio
+async def test_collect_node_stat_with_failing_plugin(stat_ctx):
+
+    class FailingComputePlugin:
+
+        async def gather_node_measures(self, ctx):
+            raise RuntimeError('oops')
+
+        async def gather_container_measures(self, ctx, container_ids):
+            raise RuntimeError('oops')
+
+    computer = Dummy()
+    computer.instance = FailingComputePlugin()
+    stat_ctx.agent.computers['failing'] = computer
+    await stat_ctx.collect_node_stat()
+    assert stat_ctx.node_metrics['mem'].current == Decimal('1024')
+    assert {*stat_ctx.kernel_metrics.keys()} == {'k1', 'k2'}
+    metrics = await stat_ctx.collect_container_stat(['c1'])
+    assert metrics['mem'].current == Decimal('256')
+
+
+@pytest.mark.asyncio
+async def test_collect_node_stat_cancelled_with_slow_plugin(stat_ctx):
+
+    class SlowComputePlugin:
+
+        def __init__(self):
+            self.started = asyncio.Event()
+            self.cancelled = False
+
+        async def gather_node_measures(self, ctx):
+            self.started.set()
+            try:
+                await asyncio.sleep(10)
+            except asyncio.CancelledError:
+                self.cancelled = True
+                raise
+            return []
+
+        async def gather_container_measures(self, ctx, container_ids):
+            return []
+
+    plugin = SlowComputePlugin()
+    computer = Dummy()
+    computer.instance = plugin
+    stat_ctx.agent.computers['slow'] = computer
+    collector = asyncio.create_task(stat_ctx.collect_node_stat())
+    await plugin.started.wait()
+    collector.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await collector
+    # let the cancellation of the plugin task be delivered.
+    await asyncio.sleep(0)
+    assert plugin.cancelled
+
+
+def test_measurements_share_empty_defaults():
+    m1 = NodeMeasurement('mem', MetricTypes.USAGE, per_node=Measurement(Decimal('1')))
+    m2 = NodeMeasurement('mem', MetricTypes.USAGE, per_node=Measurement(Decimal('2')))
+    assert m1.per_device == {}
+    assert m1.per_device is m2.per_device
+    c1 = ContainerMeasurement('mem', MetricTypes.USAGE)
+    assert c1.per_container == {}
+    with pytest.raises(TypeError):
+        c1.per_container['c1'] = Measurement(Decimal('1'))  # type: ignore